@@ -1,10 +1,20 @@
 import uvicorn
 import os
+import io
+import asyncio
+import atexit
+import hashlib
+import queue
+import subprocess
 import tempfile
+import concurrent.futures
+import numpy as np
+import soundfile as sf
+import torch
+from collections import OrderedDict
 from typing import List
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
-from pydub import AudioSegment  # 用于格式转换
+from fastapi.responses import HTMLResponse
 
 # 引入预测器
 from predictor import AASISTPredictor
@@ -12,105 +22,274 @@ from predictor import AASISTPredictor
 # ==========================================================
 # 配置路径
 # ==========================================================
-MODEL_PATH = "epoch_45_0.441.pth" 
+MODEL_PATH = "epoch_45_0.441.pth"
 CONFIG_PATH = "config_standalone_eval.json"
-THRESHOLD = 1.510585 
+THRESHOLD = 1.510585
+TARGET_SR = 16000  # AASIST 期望的采样率
 # ==========================================================
 
-# --- [关键] 配置 Pydub 使用本地 ffmpeg ---
-# 检查当前目录下是否有 ffmpeg.exe，如果有，指定给 pydub
+# --- [关键] 定位 ffmpeg ---
+# 检查当前目录下是否有 ffmpeg.exe，如果有，优先使用；否则依赖系统 PATH 中的 ffmpeg
 current_dir = os.path.dirname(os.path.abspath(__file__))
 local_ffmpeg = os.path.join(current_dir, "ffmpeg.exe")
-local_ffprobe = os.path.join(current_dir, "ffprobe.exe")
 
 if os.path.exists(local_ffmpeg):
-    AudioSegment.converter = local_ffmpeg
-    AudioSegment.ffprobe = local_ffprobe
+    FFMPEG_BIN = local_ffmpeg
     print(f"检测到本地 FFmpeg，已启用: {local_ffmpeg}")
 else:
-    print("警告: 未在当前目录检测到 ffmpeg.exe。如果系统未安装 FFmpeg，.m4a 格式将无法处理。")
+    FFMPEG_BIN = "ffmpeg"
+    print("警告: 未在当前目录检测到 ffmpeg.exe，将尝试使用系统 PATH 中的 ffmpeg。")
 # ----------------------------------------
 
+
+def decode_to_f32(path: str, sr: int = TARGET_SR) -> np.ndarray:
+    """
+    用单个 ffmpeg 进程把任意格式的音频解码为 16kHz 单声道 float32 波形。
+    解码结果直接从管道读取，不写中间 wav 文件。
+    """
+    res = subprocess.run(
+        [FFMPEG_BIN, "-v", "quiet", "-i", path,
+         "-f", "f32le", "-ar", str(sr), "-ac", "1", "pipe:1"],
+        capture_output=True, check=True
+    )
+    waveform = np.frombuffer(res.stdout, dtype=np.float32)
+    if waveform.size == 0:
+        raise ValueError("ffmpeg 解码未输出任何采样")
+    return waveform
+
+
+def decode_bytes_to_f32(content: bytes, sr: int = TARGET_SR) -> np.ndarray:
+    """
+    直接从内存中的字节解码 (ffmpeg 从 stdin 读入)，完全绕过磁盘。
+    注意: moov 原子在尾部的 m4a/mp4 等需要寻址的容器在管道输入下会
+    解码失败，调用方应退回写临时文件的路径。
+    """
+    res = subprocess.run(
+        [FFMPEG_BIN, "-v", "quiet", "-i", "pipe:0",
+         "-f", "f32le", "-ar", str(sr), "-ac", "1", "pipe:1"],
+        input=content, capture_output=True, check=True
+    )
+    waveform = np.frombuffer(res.stdout, dtype=np.float32)
+    if waveform.size == 0:
+        raise ValueError("ffmpeg 管道解码未输出任何采样")
+    return waveform
+
+
+def decode_wav_fast(content: bytes, sr: int = TARGET_SR):
+    """
+    已经是 16kHz 的 WAV (ASV 输入的常见情况) 的快速路径:
+    先用 sf.info 探测头部，采样率匹配时直接用 soundfile 读取，
+    既不启动 ffmpeg 子进程也不做重采样。
+    不适用 (非 WAV / 采样率不同) 时返回 None，由调用方走 ffmpeg 路径。
+    """
+    bio = io.BytesIO(content)
+    try:
+        info = sf.info(bio)
+    except Exception:
+        return None
+    if info.samplerate != sr:
+        return None
+    bio.seek(0)
+    data, _ = sf.read(bio, dtype="float32", always_2d=False)
+    if data.size == 0:
+        raise ValueError("WAV 文件不包含任何采样")
+    if data.ndim > 1:
+        data = data.mean(axis=1)  # 下混为单声道
+    return np.ascontiguousarray(data, dtype=np.float32)
+
+
 if not os.path.exists(MODEL_PATH) or not os.path.exists(CONFIG_PATH):
     print("错误: 找不到模型或配置文件。")
     exit()
 
 app = FastAPI(title="AASIST 语音伪造检测 (批量版)")
 
-print("正在加载模型...")
-predictor = AASISTPredictor(
-    model_path=MODEL_PATH,
-    config_path=CONFIG_PATH,
-    threshold=THRESHOLD
-)
-print("模型加载完毕。")
+# 模型在 startup 事件里懒加载: 每个 worker 进程加载一份，
+# 而 uvicorn 的主管进程只负责 fork，不再浪费一份模型内存/CUDA 上下文
+predictor: AASISTPredictor = None
 
-@app.post("/predict/")
-async def predict_audio_batch(files: List[UploadFile] = File(...)):
-    results = []
 
-    for file in files:
-        temp_input_path = None
-        temp_wav_path = None
-        
+@app.on_event("startup")
+def load_predictor():
+    global predictor
+    if predictor is None:
+        print("正在加载模型...")
+        predictor = AASISTPredictor(
+            model_path=MODEL_PATH,
+            config_path=CONFIG_PATH,
+            threshold=THRESHOLD
+        )
+        print("模型加载完毕。")
+
+# --- 解码线程池 ---
+# 解码是 CPU 密集型工作，放进按核心数配置的线程池，
+# 不占用 asyncio 默认线程池，也不阻塞事件循环
+_dec_pool = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+# ------------------
+
+# --- 临时文件槽位池 ---
+# 每个 worker 进程预分配固定数量的临时文件路径，重复使用 (打开时截断)，
+# 避免每个请求都创建+删除一个 NamedTemporaryFile 带来的文件系统元数据开销
+TEMP_SLOTS = 16
+_temp_paths: "queue.Queue[str]" = queue.Queue()
+for _slot in range(TEMP_SLOTS):
+    _temp_paths.put(os.path.join(
+        tempfile.gettempdir(), f"aasist_{os.getpid()}_{_slot}"))
+
+
+@atexit.register
+def _cleanup_temp_slots():
+    while not _temp_paths.empty():
         try:
-            # 1. 保存用户上传的原始文件
-            file_ext = os.path.splitext(file.filename)[1].lower()
-            if not file_ext:
-                file_ext = ".temp" 
+            path = _temp_paths.get_nowait()
+            if os.path.exists(path):
+                os.remove(path)
+        except Exception:
+            pass
+# ----------------------
 
-            with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as temp_file:
-                content = await file.read()
-                temp_file.write(content)
+# --- 预测结果缓存 ---
+# 以上传内容的 SHA-256 为键，命中时直接复用结果，跳过解码和前向传播
+CACHE_MAX_SIZE = 256
+_result_cache: "OrderedDict[bytes, dict]" = OrderedDict()
+_cache_lock = asyncio.Lock()
+
+
+async def _cache_get(digest: bytes):
+    async with _cache_lock:
+        result = _result_cache.get(digest)
+        if result is not None:
+            _result_cache.move_to_end(digest)
+        return result
+
+
+async def _cache_put(digest: bytes, result: dict):
+    async with _cache_lock:
+        _result_cache[digest] = result
+        _result_cache.move_to_end(digest)
+        while len(_result_cache) > CACHE_MAX_SIZE:
+            _result_cache.popitem(last=False)
+# --------------------
+
+
+async def _prepare(file: UploadFile):
+    """
+    读取单个上传文件并解码为 16kHz 单声道 float32 波形。
+    读取时顺带计算内容的 SHA-256；如果缓存中已有同样内容的预测结果，
+    直接返回缓存结果并跳过解码。
+    解码优先在内存中完成 (ffmpeg 从 stdin 读入，不写盘)；只有需要
+    寻址的容器才退回写临时文件再解码。
+    解码在线程池中执行，多个文件可以并行进行，事件循环也不被阻塞。
+    :return: (digest, waveform, cached_result)，命中缓存时 waveform 为 None
+    """
+    # 1. 分块读取上传内容，边读边计算哈希
+    hasher = hashlib.sha256()
+    buf = bytearray()
+    while True:
+        chunk = await file.read(1024 * 1024)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        buf.extend(chunk)
+    content = bytes(buf)
+    digest = hasher.digest()
+
+    # 2. 查缓存: 同样的内容不必重新解码和推理
+    cached = await _cache_get(digest)
+    if cached is not None:
+        print(f"缓存命中: {file.filename}")
+        return digest, None, cached
+
+    # 3. 解码: 16kHz WAV 直接用 soundfile 读取；
+    #    其他情况优先走 ffmpeg 内存管道，失败时退回临时文件
+    print(f"正在解码: {file.filename}")
+    loop = asyncio.get_running_loop()
+    waveform = await loop.run_in_executor(_dec_pool, decode_wav_fast, content)
+    if waveform is not None:
+        return digest, waveform, None
+    try:
+        waveform = await loop.run_in_executor(_dec_pool, decode_bytes_to_f32, content)
+    except Exception:
+        # 槽位获取必须非阻塞: 槽位只会在其他协程的 finally 里归还，
+        # 事件循环上的阻塞 get() 会让整个 worker 死锁。
+        # 池子用尽时退回一次性临时文件
+        try:
+            temp_input_path = _temp_paths.get_nowait()
+            from_pool = True
+        except queue.Empty:
+            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
                 temp_input_path = temp_file.name
-            
-            # 2. 格式转换逻辑
-            # 模型和librosa对WAV支持最好。如果不是wav，用pydub转成wav
-            target_file_path = temp_input_path
-            
-            if file_ext != ".wav":
-                print(f"正在转换格式: {file.filename} -> wav")
-                # 创建一个临时的 wav 文件名
-                temp_wav_path = temp_input_path + ".converted.wav"
-                
-                # 使用 pydub 加载并导出为 wav
-                audio = AudioSegment.from_file(temp_input_path)
-                audio.export(temp_wav_path, format="wav")
-                
-                # 将目标路径指向这个新的 wav 文件
-                target_file_path = temp_wav_path
-
-            # 3. 运行预测
-            print(f"正在处理: {file.filename}")
-            pred_result = predictor.predict(target_file_path)
-            
-            results.append({
-                "filename": file.filename,
-                "result_label": pred_result.get("label", "错误"),
-                "score": pred_result.get("score", 0),
-                "is_bonafide": pred_result.get("label") == "真实",
-                "error": pred_result.get("error", None)
-            })
+            from_pool = False
+        try:
+            with open(temp_input_path, "wb") as temp_file:
+                temp_file.write(content)
+            waveform = await loop.run_in_executor(_dec_pool, decode_to_f32, temp_input_path)
+        finally:
+            if from_pool:
+                # 归还槽位 (不删除文件，下次使用时直接截断覆盖)
+                _temp_paths.put(temp_input_path)
+            else:
+                try:
+                    os.remove(temp_input_path)
+                except OSError:
+                    pass
+    return digest, waveform, None
+
+
+@app.post("/predict/")
+async def predict_audio_batch(files: List[UploadFile] = File(...)):
+    results = [None] * len(files)
+    waveforms = []      # 成功解码的波形
+    wave_indices = []   # 波形对应的结果下标
+    wave_digests = []   # 波形对应的内容哈希 (用于写缓存)
+
+    # 第一阶段: 并发保存+解码所有上传文件
+    prepared = await asyncio.gather(
+        *[_prepare(file) for file in files], return_exceptions=True
+    )
 
-        except Exception as e:
-            print(f"文件 {file.filename} 处理出错: {e}")
-            results.append({
+    for idx, (file, item) in enumerate(zip(files, prepared)):
+        if isinstance(item, Exception):
+            print(f"文件 {file.filename} 处理出错: {item}")
+            results[idx] = {
                 "filename": file.filename,
                 "result_label": "错误",
                 "score": 0,
                 "is_bonafide": False,
-                "error": f"处理失败: {str(e)} (请检查 ffmpeg.exe 是否在目录下)"
-            })
-            
-        finally:
-            # 4. 清理所有临时文件
-            try:
-                if temp_input_path and os.path.exists(temp_input_path):
-                    os.remove(temp_input_path)
-                if temp_wav_path and os.path.exists(temp_wav_path):
-                    os.remove(temp_wav_path)
-            except:
-                pass
+                "error": f"处理失败: {str(item)} (请检查 ffmpeg 是否可用)"
+            }
+            continue
+
+        digest, waveform, cached = item
+        if cached is not None:
+            # 缓存命中: 直接复用之前的预测结果，换上当前的文件名
+            results[idx] = dict(cached, filename=file.filename)
+        else:
+            waveforms.append(waveform)
+            wave_indices.append(idx)
+            wave_digests.append(digest)
+
+    # 第二阶段: 把波形提交到微批队列，和其他并发请求凑成一个批次推理
+    if waveforms:
+        pred_results = await asyncio.gather(
+            *[predictor.submit(w) for w in waveforms], return_exceptions=True
+        )
+        pred_results = [
+            {"error": f"推理失败: {str(r)}"} if isinstance(r, Exception) else r
+            for r in pred_results
+        ]
+
+        for idx, digest, pred_result in zip(wave_indices, wave_digests, pred_results):
+            results[idx] = {
+                "filename": files[idx].filename,
+                "result_label": pred_result.get("label", "错误"),
+                "score": pred_result.get("score", 0),
+                "is_bonafide": pred_result.get("label") == "真实",
+                "error": pred_result.get("error", None)
+            }
+            # 只缓存成功的预测
+            if pred_result.get("error") is None:
+                await _cache_put(digest, results[idx])
 
     return results
 
@@ -124,4 +303,15 @@ async def get_frontend():
 
 if __name__ == "__main__":
     print("启动服务器，访问 http://127.0.0.1:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # uvloop 只支持类 Unix 系统，Windows 上退回默认事件循环
+    # 每个 worker 都持有一份完整的模型副本:
+    # GPU 上多份 CUDA 上下文很容易显存溢出，只开 1 个 worker；
+    # CPU 上按核心数开，让解码和推理吃满多核
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop" if os.name != "nt" else "asyncio",
+        http="httptools",
+        workers=1 if torch.cuda.is_available() else os.cpu_count(),
+    )
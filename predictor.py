@@ -1,20 +1,46 @@
+import asyncio
+import concurrent.futures
 import json
+import time
 from pathlib import Path
 import numpy as np
 import torch
 import librosa  # 我们使用 librosa 来确保音频以正确的采样率加载
+import soundfile as sf
+import soxr
 from models.AASIST import Model as AASIST_L_Model
 
+
+def load_audio(file_path: str, target_sr: int = 16000) -> np.ndarray:
+    """
+    加载音频并返回 target_sr 采样率的单声道 float32 波形。
+    WAV 文件走 soundfile + soxr 快速路径 (避开 librosa 的重型封装)，
+    其他格式或读取失败时退回 librosa.load。
+    """
+    try:
+        data, sr = sf.read(file_path, dtype="float32", always_2d=False)
+        if data.ndim > 1:
+            data = data.mean(axis=1)  # 下混为单声道
+        if sr != target_sr:
+            data = soxr.resample(data, sr, target_sr)
+        return np.ascontiguousarray(data, dtype=np.float32)
+    except Exception:
+        X, _ = librosa.load(file_path, sr=target_sr, mono=True)
+        return X
+
 # --- 从您的 data_utils.py 复制 'pad' 函数 ---
 # 将它放在这里可以使 predictor.py 自给自足
 def pad(x, max_len=64600):
-    x_len = x.shape[0]
-    if x_len >= max_len:
+    # 空波形必须在这里拦截: np.resize 会把它铺成全零，
+    # 模型就会对纯静音给出一个看似正常的判定
+    if x.shape[0] == 0:
+        raise ValueError("音频不包含任何采样")
+    x = x.astype(np.float32, copy=False)
+    if x.shape[0] >= max_len:
         return x[:max_len]
-    # need to pad
-    num_repeats = int(max_len / x_len) + 1
-    padded_x = np.tile(x, (1, num_repeats))[:, :max_len][0]
-    return padded_x
+    # 循环重复到目标长度: np.resize 自带平铺+截断，
+    # 不再构造 2 倍大小的二维 tile 中间数组
+    return np.resize(x, max_len)
 # ----------------------------------------------
 
 class AASISTPredictor:
@@ -38,6 +64,14 @@ class AASISTPredictor:
             self.device = torch.device("cpu")
             print("正在使用 CPU")
 
+        # 1b. 全局推理设置
+        #     输入形状固定为 [N, 64600]，开启 cuDNN autotuner 让它一次性
+        #     选出最快的卷积算法。梯度在 _forward 里用 inference_mode
+        #     关闭: 梯度模式是线程局部的，全局开关管不到推理线程池
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
         # 2. 加载模型配置
         with open(config_path, "r") as f:
             self.config = json.load(f)
@@ -54,23 +88,110 @@ class AASISTPredictor:
         self.model.eval()
         print("模型已成功加载并设置到评估模式。")
 
+        # 5b. (仅 CUDA) 半精度推理
+        #     权重转为 FP16 可将激活字节数减半，并启用 Tensor Core。
+        #     注意: FP16 在阈值 (≈1.51) 附近的分辨率只有 ~1e-3，
+        #     分数紧贴阈值的样本判定可能与 FP32 不一致；
+        #     该差异尚未在验证集上量化过
+        self.use_fp16 = torch.cuda.is_available() and self.device.type == "cuda"
+        if self.use_fp16:
+            self.model = self.model.half()
+            print("已启用 FP16 半精度推理。")
+
+        # 5c. 尝试编译模型 (融合算子、降低每次调用的 Python 开销)
+        #     torch.compile 是惰性的，真正的后端失败 (缺 Triton、没有
+        #     C++ 工具链等) 要到第一次前向传播才会抛出，所以先留住
+        #     eager 模型，预热阶段失败时回退
+        self._eager_model = self.model
+        try:
+            self.model = torch.compile(self.model, mode="reduce-overhead", fullgraph=False)
+            print("已启用 torch.compile。")
+        except Exception:
+            pass
+
         # 6. 设置参数
         self.cut = 64600  # 固定音频长度 (来自 evaluate_custom.py)
         self.target_sr = 16000  # AASIST 期望的采样率
         self.threshold = threshold # 判定阈值
+        self.max_batch = 32  # 批量推理的最大批次大小
+
+        # 7. (仅 CUDA) 预分配锁页内存缓冲区
+        #    复用同一块 pinned host 缓冲和 device 张量，避免每次请求
+        #    都重新分配内存。批次由微批队列串行执行，批次之间没有
+        #    可重叠的工作，单缓冲即可
+        if self.device.type == "cuda":
+            self._host = torch.empty(
+                (self.max_batch, self.cut), dtype=torch.float32, pin_memory=True
+            )
+            self._dev = torch.empty_like(self._host, device=self.device)
+        else:
+            self._host = None
+            self._dev = None
 
-    def predict(self, file_path: str) -> dict:
+        # 7b. 微批队列: 把同一小时间窗内并发提交的预测请求凑成一个批次
+        #     队列和后台任务在第一次 submit 时创建 (需要运行中的事件循环)
+        self._queue = None
+        self._batch_task = None
+        self.batch_window = 0.01  # 凑批等待窗口 (秒)
+        # 推理专用的单线程池: 让阻塞的 CUDA 调用离开事件循环线程，
+        # 同时保证 GPU 调用串行化 (锁页缓冲也因此不会被并发写)
+        self._inf_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        # 8. 预热: 对单条和满批两种形状各跑一次全零前向传播，把
+        #    torch.compile 图编译和 cuDNN 算法选择的开销都挪到启动阶段。
+        #    编译后端不可用也在这里暴露: 回退到 eager 模型重新预热，
+        #    而不是让 worker 启动失败
+        warmup_start = time.time()
+        try:
+            self._warmup()
+        except Exception as e:
+            if self.model is self._eager_model:
+                raise
+            print(f"torch.compile 后端不可用，回退 eager 模式: {e}")
+            self.model = self._eager_model
+            self._warmup()
+        print(f"模型预热完成，耗时 {time.time() - warmup_start:.2f} 秒。")
+
+    def _warmup(self):
+        """对单条和满批两种输入形状各执行一次全零前向传播。"""
+        for bs in (1, self.max_batch):
+            self._forward(torch.zeros(bs, self.cut, device=self.device))
+        if self.device.type == "cuda":
+            torch.cuda.synchronize()
+
+    def _forward(self, x_inp: torch.Tensor) -> torch.Tensor:
         """
-        对单个 .wav 文件执行预测。
-        :param file_path: 音频文件的路径
+        执行一次前向传播，返回 [N, 2] 的输出张量。
+        CUDA 下以 FP16 + autocast 运行。
+        梯度模式是线程局部的，而推理跑在专用线程池里，所以必须在
+        这里用 inference_mode 关闭梯度，不能依赖主线程的全局开关。
+        """
+        with torch.inference_mode():
+            if self.use_fp16:
+                x_inp = x_inp.half()
+                with torch.autocast("cuda", dtype=torch.float16):
+                    _, batch_out = self.model(x_inp)
+            else:
+                _, batch_out = self.model(x_inp)
+        return batch_out
+
+    def predict(self, file_path: str = None, waveform: np.ndarray = None) -> dict:
+        """
+        对单个音频执行预测。
+        :param file_path: 音频文件的路径 (由 load_audio 加载)
+        :param waveform: 已经解码好的 16kHz 单声道 float32 波形 (跳过加载步骤)
         :return: 包含结果和分数的字典
         """
         try:
             # 1. 加载音频
-            #    - 使用 librosa 确保:
+            #    - 如果调用方已经解码好波形 (例如 ffmpeg 管道)，直接使用
+            #    - 否则通过 load_audio 确保:
             #      a) 音频被重新采样到 self.target_sr (16000 Hz)
-            #      b) 音频被转换为单声道 (mono=True)
-            X, sr = librosa.load(file_path, sr=self.target_sr, mono=True)
+            #      b) 音频被转换为单声道
+            if waveform is not None:
+                X = waveform
+            else:
+                X = load_audio(file_path, self.target_sr)
 
             # 2. 填充/裁剪
             X_pad = pad(X, self.cut)
@@ -82,10 +203,8 @@ class AASISTPredictor:
             x_inp = x_inp.unsqueeze(0)
 
             # 5. 执行推理
-            with torch.no_grad():
-                # _, batch_out = model(batch_x)
-                # 您的 evaluate_custom.py 指出 batch_out[:, 1] 是 bonafide 分数
-                _, batch_out = self.model(x_inp)
+            # 您的 evaluate_custom.py 指出 batch_out[:, 1] 是 bonafide 分数
+            batch_out = self._forward(x_inp)
             
             # 提取 bonafide (真实) 分数
             # batch_out 形状为 [1, 2], 我们需要 [0, 1]
@@ -105,4 +224,99 @@ class AASISTPredictor:
 
         except Exception as e:
             print(f"处理文件 {file_path} 时出错: {e}")
-            return {"error": str(e)}
\ No newline at end of file
+            return {"error": str(e)}
+
+    def predict_batch(self, waveforms: list) -> list:
+        """
+        对一批已解码的波形执行预测 (单次前向传播)。
+        把 N 条波形堆叠成 [N, 64600] 的张量，只调用一次模型，
+        避免逐条推理时 batch=1 带来的内核启动开销。
+        :param waveforms: 16kHz 单声道 float32 波形的列表
+        :return: 与输入顺序对应的结果字典列表
+        """
+        n = len(waveforms)
+        if n == 0:
+            return []
+
+        # 超过预分配缓冲大小的批次按块切分，逐块推理
+        if n > self.max_batch:
+            results = []
+            for i in range(0, n, self.max_batch):
+                results.extend(self.predict_batch(waveforms[i:i + self.max_batch]))
+            return results
+
+        # 1. 填充/裁剪到固定长度，写入预分配的锁页缓冲 (CPU 路径下用普通数组)
+        if self._host is not None:
+            host = self._host[:n]
+            host_np = host.numpy()
+            for i, X in enumerate(waveforms):
+                host_np[i] = pad(X, self.cut)
+
+            # 2. 异步拷贝到复用的 device 张量并执行推理
+            self._dev[:n].copy_(host, non_blocking=True)
+            x_inp = self._dev[:n]
+        else:
+            batch = np.empty((n, self.cut), dtype=np.float32)
+            for i, X in enumerate(waveforms):
+                batch[i] = pad(X, self.cut)
+            x_inp = torch.from_numpy(batch).to(self.device, non_blocking=True)
+
+        batch_out = self._forward(x_inp)
+
+        # 3. 提取 bonafide (真实) 分数，阈值判定在设备上向量化完成，
+        #    分数和判定结果各做一次 GPU→CPU 传输，不逐条 .item() 同步
+        scores_t = batch_out[:, 1]
+        labels_t = scores_t > self.threshold
+        scores = scores_t.detach().float().cpu().numpy()
+        labels = labels_t.detach().cpu().numpy()
+
+        results = []
+        for score, is_bonafide in zip(scores, labels):
+            results.append({
+                "label": "真实" if is_bonafide else "伪造",
+                "score": float(score),
+                "threshold": self.threshold
+            })
+        return results
+
+    async def submit(self, waveform: np.ndarray) -> dict:
+        """
+        把单条波形提交到微批队列并等待结果。
+        短时间窗内 (batch_window) 并发提交的请求会被凑成一个批次，
+        由后台任务统一做一次前向传播，避免大量 batch=1 的推理。
+        :param waveform: 16kHz 单声道 float32 波形
+        :return: 与 predict_batch 单条结果相同的字典
+        """
+        loop = asyncio.get_running_loop()
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._batch_task = loop.create_task(self._batch_worker())
+
+        future = loop.create_future()
+        await self._queue.put((waveform, future))
+        return await future
+
+    async def _batch_worker(self):
+        """后台任务: 不断从队列里取出等待的请求，凑批后统一推理。"""
+        while True:
+            # 阻塞等待第一条请求，然后在时间窗内尽量多收几条
+            items = [await self._queue.get()]
+            while len(items) < self.max_batch:
+                try:
+                    items.append(await asyncio.wait_for(
+                        self._queue.get(), timeout=self.batch_window))
+                except asyncio.TimeoutError:
+                    break
+
+            waveforms = [waveform for waveform, _ in items]
+            try:
+                # 推理放进专用单线程池执行，不阻塞事件循环且保证串行
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self._inf_pool, self.predict_batch, waveforms)
+                for (_, future), result in zip(items, results):
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
\ No newline at end of file